@@ -9,14 +9,206 @@
 %apply Pointer NONNULL { struct tracecmd_input *handle };
 %apply Pointer NONNULL { struct pevent *pevent };
 %apply Pointer NONNULL { struct format_field * };
+%apply Pointer NONNULL { struct pevent_record * };
+/* the one record argument that may legitimately be NULL */
+%typemap(check) struct pevent_record *last_record "";
 %apply unsigned long long *OUTPUT {unsigned long long *}
 %apply int *OUTPUT {int *}
 
 
 %{
 #include "trace-cmd.h"
+
+/*
+ * A python object holding a reference to a record. The record is
+ * freed by tp_dealloc when the last python reference goes away, so
+ * no python level destructor has to run for it.
+ */
+typedef struct {
+	PyObject_HEAD
+	struct pevent_record	*rec;
+} py_record;
+
+/*
+ * Freeing a record drops a reference on its page and may unlink the
+ * page from the handle's page list, the same state the record readers
+ * change. That runs with the GIL held, so the readers must not drop
+ * it either: the GIL is what keeps a read and a free apart.
+ */
+static void py_record_dealloc(PyObject *self)
+{
+	free_record(((py_record *)self)->rec);
+	PyObject_Del(self);
+}
+
+static PyTypeObject py_record_type = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	.tp_name	= "ctracecmd.record",
+	.tp_basicsize	= sizeof(py_record),
+	.tp_dealloc	= py_record_dealloc,
+	.tp_flags	= Py_TPFLAGS_DEFAULT,
+	.tp_doc		= "Reference to a trace record",
+};
+
+/* Takes over the reference to @rec */
+static PyObject *py_record_new(struct pevent_record *rec)
+{
+	py_record *obj;
+
+	if (!rec)
+		Py_RETURN_NONE;
+
+	obj = PyObject_New(py_record, &py_record_type);
+	if (!obj) {
+		free_record(rec);
+		return NULL;
+	}
+	obj->rec = rec;
+
+	return (PyObject *)obj;
+}
+
+/* Append @val to @list, dropping the reference to @val */
+static int py_list_append_new(PyObject *list, PyObject *val)
+{
+	int ret;
+
+	if (!val)
+		return -1;
+	ret = PyList_Append(list, val);
+	Py_DECREF(val);
+	return ret;
+}
+
+/*
+ * Find the string stored in field @f of @r and its length, or return
+ * NULL with a python exception set.
+ */
+static const char *py_field_str(struct format_field *f,
+				struct pevent_record *r, Py_ssize_t *len)
+{
+	const char *str;
+
+	if (!strncmp(f->type, "__data_loc ", 11)) {
+		unsigned long long val;
+		int offset;
+
+		if (pevent_read_number_field(f, r->data, &val)) {
+			PyErr_SetString(PyExc_TypeError,
+					"Field is not a valid number");
+			return NULL;
+		}
+
+		/*
+		 * The actual length of the dynamic array is stored
+		 * in the top half of the field, and the offset
+		 * is in the bottom half of the 32 bit field.
+		 */
+		offset = val & 0xffff;
+
+		str = (char *)r->data + offset;
+		*len = strlen(str);
+		return str;
+	}
+
+	str = (char *)r->data + f->offset;
+	*len = strnlen(str, f->size);
+	return str;
+}
+
+/* Read the next record of @cpu, or of all CPUs in time order if -1 */
+static struct pevent_record *py_read_record(struct tracecmd_input *handle,
+					    int cpu)
+{
+	if (cpu < 0)
+		return tracecmd_read_next_data(handle, NULL);
+	return tracecmd_read_data(handle, cpu);
+}
+
+/*
+ * Append the value of field @f of every @ef record of @cpu with a
+ * timestamp in [@start_ts, @end_ts] to @list. An @end_ts of 0 means
+ * no upper bound. The CPU iterator is put back where it was. Returns
+ * -1 with a python exception set on error.
+ */
+static int py_read_cpu_field(struct tracecmd_input *handle, int cpu,
+			     struct event_format *ef, struct format_field *f,
+			     unsigned long long start_ts,
+			     unsigned long long end_ts, PyObject *list)
+{
+	struct pevent *pevent = tracecmd_get_pevent(handle);
+	struct pevent_record *rec;
+	unsigned long long offset;
+	unsigned long long val;
+	int ret = 0;
+
+	offset = tracecmd_get_cursor(handle, cpu);
+
+	if (!start_ts)
+		rec = tracecmd_read_cpu_first(handle, cpu);
+	else if (!tracecmd_set_cpu_to_timestamp(handle, cpu, start_ts))
+		rec = tracecmd_read_data(handle, cpu);
+	else
+		rec = NULL;
+
+	for (; rec; rec = tracecmd_read_data(handle, cpu)) {
+		if (end_ts && rec->ts > end_ts) {
+			free_record(rec);
+			break;
+		}
+
+		if (rec->ts < start_ts ||
+		    pevent_data_type(pevent, rec) != ef->id ||
+		    pevent_read_number_field(f, rec->data, &val)) {
+			free_record(rec);
+			continue;
+		}
+		free_record(rec);
+
+		if (val > LONG_MAX)
+			ret = py_list_append_new(list,
+					PyLong_FromUnsignedLongLong(val));
+		else
+			ret = py_list_append_new(list, PyInt_FromLong(val));
+		if (ret)
+			break;
+	}
+
+	tracecmd_set_cursor(handle, cpu, offset);
+
+	return ret;
+}
 %}
 
+%init %{
+	if (PyType_Ready(&py_record_type) < 0)
+		return;
+%}
+
+/* Records are passed around as py_record objects or plain SWIG pointers */
+%typemap(in) struct pevent_record * {
+	if (Py_TYPE($input) == &py_record_type) {
+		$1 = ((py_record *)$input)->rec;
+	} else if (!SWIG_IsOK(SWIG_ConvertPtr($input, (void **)&$1,
+					      $descriptor, 0))) {
+		SWIG_exception_fail(SWIG_TypeError,
+			"in method '$symname', expected a record");
+	}
+}
+
+/* The records returned by these must be freed, let python own them */
+%typemap(out) struct pevent_record *tracecmd_read_data,
+	      struct pevent_record *tracecmd_read_at,
+	      struct pevent_record *tracecmd_read_next_data,
+	      struct pevent_record *tracecmd_read_prev,
+	      struct pevent_record *tracecmd_read_cpu_first,
+	      struct pevent_record *tracecmd_read_cpu_last,
+	      struct pevent_record *tracecmd_peek_data_ref {
+	$result = py_record_new($1);
+	if (!$result)
+		SWIG_fail;
+}
+
 
 %typemap(in) PyObject *pyfunc {
 	if (!PyCallable_Check($input)) {
@@ -27,6 +219,8 @@
 }
 
 %ignore python_callback;
+%ignore free_record;
+%rename(free_record) py_free_record;
 
 %inline %{
 static int python_callback(struct trace_seq *s,
@@ -49,6 +243,29 @@ void py_pevent_register_event_handler(struct pevent *pevent, int id,
 				      python_callback, pyfunc);
 }
 
+/*
+ * Records held by a python record object are freed when the object
+ * goes away. Freeing one by hand releases it early and empties the
+ * object, so that it is not freed a second time.
+ */
+static PyObject *py_free_record(PyObject *obj)
+{
+	struct pevent_record *rec = NULL;
+
+	if (Py_TYPE(obj) == &py_record_type) {
+		rec = ((py_record *)obj)->rec;
+		((py_record *)obj)->rec = NULL;
+	} else if (!SWIG_IsOK(SWIG_ConvertPtr(obj, (void **)&rec,
+					      SWIGTYPE_p_pevent_record, 0))) {
+		PyErr_SetString(PyExc_TypeError, "expected a record");
+		return NULL;
+	}
+
+	free_record(rec);
+
+	Py_RETURN_NONE;
+}
+
 static PyObject *py_field_get_data(struct format_field *f, struct pevent_record *r)
 {
 	if (!strncmp(f->type, "__data_loc ", 11)) {
@@ -75,30 +292,314 @@ static PyObject *py_field_get_data(struct format_field *f, struct pevent_record
 	return PyBuffer_FromMemory((char *)r->data + f->offset, f->size);
 }
 
+/*
+ * Return the value of the number field @f in @r, or None if @f
+ * is not a number.
+ */
+static PyObject *py_field_read_number(struct format_field *f,
+				      struct pevent_record *r)
+{
+	unsigned long long val;
+
+	if (pevent_read_number_field(f, r->data, &val))
+		Py_RETURN_NONE;
+
+	if (val > LONG_MAX)
+		return PyLong_FromUnsignedLongLong(val);
+	return PyInt_FromLong(val);
+}
+
 static PyObject *py_field_get_str(struct format_field *f, struct pevent_record *r)
 {
-	if (!strncmp(f->type, "__data_loc ", 11)) {
-		unsigned long long val;
-		int offset;
+	const char *str;
+	Py_ssize_t len;
 
-		if (pevent_read_number_field(f, r->data, &val)) {
-			PyErr_SetString(PyExc_TypeError,
-					"Field is not a valid number");
+	str = py_field_str(f, r, &len);
+	if (!str)
+		return NULL;
+
+	return PyString_FromStringAndSize(str, len);
+}
+
+/*
+ * Copy the string in field @f of @r into the bytearray @buf, growing
+ * @buf if it is too small, and return the string's length. Reusing
+ * one buffer avoids allocating a python string per field read.
+ */
+static PyObject *py_field_read_str_into(struct format_field *f,
+					struct pevent_record *r,
+					PyObject *buf)
+{
+	const char *str;
+	Py_ssize_t len;
+
+	if (!PyByteArray_Check(buf)) {
+		PyErr_SetString(PyExc_TypeError, "buffer must be a bytearray");
+		return NULL;
+	}
+
+	str = py_field_str(f, r, &len);
+	if (!str)
+		return NULL;
+
+	if (PyByteArray_GET_SIZE(buf) < len &&
+	    PyByteArray_Resize(buf, len))
+		return NULL;
+
+	memcpy(PyByteArray_AS_STRING(buf), str, len);
+
+	return PyInt_FromSsize_t(len);
+}
+
+/*
+ * Return the value of field @f of @r in the form its type suggests:
+ * a string for string fields, a buffer for other arrays and a number
+ * for everything else.
+ */
+static PyObject *py_field_value(struct format_field *f,
+				struct pevent_record *r)
+{
+	if (f->flags & FIELD_IS_STRING)
+		return py_field_get_str(f, r);
+	if (f->flags & FIELD_IS_ARRAY)
+		return py_field_get_data(f, r);
+	return py_field_read_number(f, r);
+}
+
+/*
+ * Read up to @count records from @cpu (or from all CPUs in time order
+ * if @cpu is -1) in a single call and return them as a list of
+ * (record, type) tuples. An empty list means there is no more data.
+ */
+static PyObject *py_read_data_batch(struct tracecmd_input *handle,
+				    int cpu, int count)
+{
+	struct pevent *pevent = tracecmd_get_pevent(handle);
+	struct pevent_record *rec;
+	PyObject *list;
+	PyObject *item;
+	PyObject *obj;
+	int type;
+	int i;
+
+	if (count <= 0) {
+		PyErr_SetString(PyExc_ValueError, "count must be positive");
+		return NULL;
+	}
+
+	list = PyList_New(0);
+	if (!list)
+		return NULL;
+
+	for (i = 0; i < count; i++) {
+		rec = py_read_record(handle, cpu);
+		if (!rec)
+			break;
+
+		type = pevent_data_type(pevent, rec);
+		obj = py_record_new(rec);
+		if (!obj)
+			goto fail;
+
+		item = Py_BuildValue("(Ni)", obj, type);
+		if (!item)
+			goto fail;
+		if (PyList_Append(list, item)) {
+			Py_DECREF(item);
+			goto fail;
+		}
+		Py_DECREF(item);
+	}
+
+	return list;
+
+ fail:
+	Py_DECREF(list);
+	return NULL;
+}
+
+/*
+ * Read up to @count records from @cpu (-1 for all CPUs in time
+ * order) and return their timestamps, cpus, types and pids as a
+ * tuple of four lists. The pid list is None unless @want_pid is set.
+ * The records are freed before returning, so no python object is
+ * created for them.
+ */
+static PyObject *py_read_raw_batch(struct tracecmd_input *handle,
+				   int cpu, int count, int want_pid)
+{
+	struct pevent *pevent = tracecmd_get_pevent(handle);
+	struct pevent_record *rec;
+	PyObject *ts, *cpus, *types, *pids;
+	int err;
+	int i;
+
+	if (count <= 0) {
+		PyErr_SetString(PyExc_ValueError, "count must be positive");
+		return NULL;
+	}
+
+	ts = PyList_New(0);
+	cpus = PyList_New(0);
+	types = PyList_New(0);
+	if (want_pid) {
+		pids = PyList_New(0);
+	} else {
+		Py_INCREF(Py_None);
+		pids = Py_None;
+	}
+	if (!ts || !cpus || !types || !pids)
+		goto fail;
+
+	for (i = 0; i < count; i++) {
+		rec = py_read_record(handle, cpu);
+		if (!rec)
+			break;
+
+		err = py_list_append_new(ts,
+				PyLong_FromUnsignedLongLong(rec->ts)) ||
+		      py_list_append_new(cpus, PyInt_FromLong(rec->cpu)) ||
+		      py_list_append_new(types,
+				PyInt_FromLong(pevent_data_type(pevent, rec)));
+		if (!err && want_pid)
+			err = py_list_append_new(pids,
+				PyInt_FromLong(pevent_data_pid(pevent, rec)));
+		free_record(rec);
+		if (err)
+			goto fail;
+	}
+
+	return Py_BuildValue("(NNNN)", ts, cpus, types, pids);
+
+ fail:
+	Py_XDECREF(ts);
+	Py_XDECREF(cpus);
+	Py_XDECREF(types);
+	Py_XDECREF(pids);
+	return NULL;
+}
+
+/*
+ * Return a list holding the (first, last) timestamps of each CPU,
+ * with zeros for a CPU that has no data. Each CPU iterator is put
+ * back where it was.
+ */
+static PyObject *py_tracecmd_cpu_time_range(struct tracecmd_input *handle)
+{
+	struct pevent_record *rec;
+	unsigned long long offset;
+	unsigned long long first;
+	unsigned long long last;
+	PyObject *list;
+	PyObject *item;
+	int cpus = tracecmd_cpus(handle);
+	int cpu;
+
+	list = PyList_New(cpus);
+	if (!list)
+		return NULL;
+
+	for (cpu = 0; cpu < cpus; cpu++) {
+		first = last = 0;
+		offset = tracecmd_get_cursor(handle, cpu);
+
+		rec = tracecmd_read_cpu_first(handle, cpu);
+		if (rec) {
+			first = rec->ts;
+			free_record(rec);
+		}
+		rec = tracecmd_read_cpu_last(handle, cpu);
+		if (rec) {
+			last = rec->ts;
+			free_record(rec);
+		}
+
+		tracecmd_set_cursor(handle, cpu, offset);
+
+		item = Py_BuildValue("(KK)", first, last);
+		if (!item) {
+			Py_DECREF(list);
 			return NULL;
 		}
+		PyList_SET_ITEM(list, cpu, item);
+	}
 
-		/*
-		 * The actual length of the dynamic array is stored
-		 * in the top half of the field, and the offset
-		 * is in the bottom half of the 32 bit field.
-		 */
-		offset = val & 0xffff;
+	return list;
+}
 
-		return PyString_FromString((char *)r->data + offset);
+/*
+ * Return a list holding number field @f of every @ef event of @cpu,
+ * or of each CPU in turn if @cpu is -1, whose timestamp lies in
+ * [@start_ts, @end_ts] (no upper bound if @end_ts is 0). Only the
+ * values become python objects, and the CPU iterators are left
+ * where they were.
+ */
+static PyObject *py_read_field_vector(struct tracecmd_input *handle,
+				      int cpu, struct event_format *ef,
+				      struct format_field *f,
+				      unsigned long long start_ts,
+				      unsigned long long end_ts)
+{
+	int cpus = tracecmd_cpus(handle);
+	PyObject *list;
+	int first, last;
+	int i;
+
+	if (!ef) {
+		PyErr_SetString(PyExc_ValueError, "Received a NULL pointer.");
+		return NULL;
 	}
+	if (cpu < -1 || cpu >= cpus) {
+		PyErr_SetString(PyExc_ValueError, "invalid cpu");
+		return NULL;
+	}
+
+	first = cpu < 0 ? 0 : cpu;
+	last = cpu < 0 ? cpus - 1 : cpu;
+
+	list = PyList_New(0);
+	if (!list)
+		return NULL;
+
+	for (i = first; i <= last; i++) {
+		if (py_read_cpu_field(handle, i, ef, f, start_ts, end_ts,
+				      list)) {
+			Py_DECREF(list);
+			return NULL;
+		}
+	}
+
+	return list;
+}
+
+/*
+ * Return the (cpu, ts, type) tuple describing a record
+ */
+static PyObject *py_event_basic_info(struct pevent *pevent,
+				     struct pevent_record *r)
+{
+	return Py_BuildValue("(iKi)", r->cpu, r->ts,
+			     pevent_data_type(pevent, r));
+}
+
+/*
+ * Return the one line description of a record used by Event.__str__()
+ */
+static PyObject *py_event_format_str(struct pevent *pevent,
+				     struct pevent_record *r,
+				     struct event_format *ef)
+{
+	char ts[64];
+	int pid;
+
+	snprintf(ts, sizeof(ts), "%llu.%09llu",
+		 r->ts / 1000000000ULL, r->ts % 1000000000ULL);
+	pid = pevent_data_pid(pevent, r);
 
-	return PyString_FromStringAndSize((char *)r->data + f->offset,
-				strnlen((char *)r->data + f->offset, f->size));
+	return PyString_FromFormat("%s CPU%d %s: pid=%d comm=%s type=%d",
+				   ts, r->cpu, ef ? ef->name : "<unknown>",
+				   pid, pevent_data_comm_from_pid(pevent, pid),
+				   pevent_data_type(pevent, r));
 }
 
 static PyObject *py_format_get_keys(struct event_format *ef)
@@ -129,13 +630,13 @@ static int python_callback(struct trace_seq *s,
 	PyObject *arglist, *result;
 	int r = 0;
 
+	/* the python record object drops this reference */
 	record->ref_count++;
 
-	arglist = Py_BuildValue("(OOO)",
+	arglist = Py_BuildValue("(NNN)",
 		SWIG_NewPointerObj(SWIG_as_voidptr(s),
 				   SWIGTYPE_p_trace_seq, 0),
-		SWIG_NewPointerObj(SWIG_as_voidptr(record),
-				   SWIGTYPE_p_pevent_record, 0),
+		py_record_new(record),
 		SWIG_NewPointerObj(SWIG_as_voidptr(event),
 				   SWIGTYPE_p_event_format, 0));
 
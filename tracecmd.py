@@ -18,7 +18,6 @@
 # 2009-Dec-17:	Initial version by Darren Hart <dvhltc@us.ibm.com>
 #
 
-from functools import update_wrapper
 from ctracecmd import *
 from UserDict import DictMixin
 
@@ -33,44 +32,70 @@ and it is recommended applications not use it directly.
 TODO: consider a complete class hierarchy of ftrace events...
 """
 
-def cached_property(func, name=None):
-    if name is None:
-        name = func.__name__
-    def _get(self):
-        try:
-            return self.__cached_properties[name]
-        except AttributeError:
-            self.__cached_properties = {}
-        except KeyError:
-            pass
-        value = func(self)
-        self.__cached_properties[name] = value
-        return value
-    update_wrapper(_get, func)
-    def _del(self):
-        self.__cached_properties.pop(name, None)
-    return property(_get, None, _del)
+# marks a lazily computed attribute that has not been computed yet
+_MISSING = object()
+
+# the columns Trace.raw_events() can return, in py_read_raw_batch() order
+_RAW_FIELDS = ('ts', 'cpu', 'type', 'pid')
+
+def _format_name(format):
+    if format is None:
+        return None
+    return intern(event_format_name_get(format))
 
 class Event(object, DictMixin):
     """
     This class can be used to access event data
     according to an event's record and format.
     """
-    def __init__(self, pevent, record, format):
+    def __init__(self, pevent, record, format, fields=None, own_fields=None,
+                 comms=None, name=_MISSING):
         self._pevent = pevent
         self._record = record
         self._format = format
+        # field and pid -> comm lookups, shared by all events of a trace;
+        # @own_fields caches [] lookups, which skip the common fields
+        if fields is None:
+            fields = {}
+        self._fields = fields
+        if own_fields is None:
+            own_fields = {}
+        self._own_fields = own_fields
+        if comms is None:
+            comms = {}
+        self._comms = comms
+        self.cpu, self.ts, self.type = py_event_basic_info(pevent, record)
+        # callers reading many events pass in a name they have cached
+        if name is _MISSING:
+            name = _format_name(format)
+        self.name = name
+        self._comm = _MISSING
+        self._pid = _MISSING
 
     def __str__(self):
-        return "%d.%d CPU%d %s: pid=%d comm=%s type=%d" % \
-               (self.ts/1000000000, self.ts%1000000000, self.cpu, self.name,
-                self.num_field("common_pid"), self.comm, self.type)
+        return py_event_format_str(self._pevent, self._record, self._format)
 
-    def __del__(self):
-        free_record(self._record)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Drop the event's reference to its record, so the record is
+        freed now unless a Field taken from this event still holds
+        it. The fields of a closed event can no longer be read.
+        """
+        self._record = None
 
     def __getitem__(self, n):
-        f = pevent_find_field(self._format, n)
+        key = (self.type, n)
+        try:
+            f = self._own_fields[key]
+        except KeyError:
+            f = pevent_find_field(self._format, n)
+            self._own_fields[key] = f
         if f is None:
             raise KeyError("no field '%s'" % n)
         return Field(self._record, f)
@@ -78,45 +103,73 @@ class Event(object, DictMixin):
     def keys(self):
         return py_format_get_keys(self._format)
 
-    @cached_property
+    @property
     def comm(self):
-        return pevent_data_comm_from_pid(self._pevent, self.pid)
-
-    @cached_property
-    def cpu(self):
-        return pevent_record_cpu_get(self._record)
-
-    @cached_property
-    def name(self):
-        return event_format_name_get(self._format)
-
-    @cached_property
+        comm = self._comm
+        if comm is _MISSING:
+            pid = self.pid
+            try:
+                comm = self._comms[pid]
+            except KeyError:
+                comm = intern(pevent_data_comm_from_pid(self._pevent, pid))
+                self._comms[pid] = comm
+            self._comm = comm
+        return comm
+
+    @property
     def pid(self):
-        return pevent_data_pid(self._pevent, self._record)
-
-    @cached_property
-    def ts(self):
-        return pevent_record_ts_get(self._record)
-
-    @cached_property
-    def type(self):
-        return pevent_data_type(self._pevent, self._record)
+        pid = self._pid
+        if pid is _MISSING:
+            pid = pevent_data_pid(self._pevent, self._record)
+            self._pid = pid
+        return pid
+
+    def _any_field(self, name):
+        key = (self.type, name)
+        try:
+            return self._fields[key]
+        except KeyError:
+            f = pevent_find_any_field(self._format, name)
+            self._fields[key] = f
+            return f
 
     def num_field(self, name):
-        f = pevent_find_any_field(self._format, name)
+        f = self._any_field(name)
         if f is None:
             return None
-        ret, val = pevent_read_number_field(f, pevent_record_data_get(self._record))
-        if ret:
-            return None
-        return val
+        return py_field_read_number(f, self._record)
 
     def str_field(self, name):
-        f = pevent_find_any_field(self._format, name)
+        f = self._any_field(name)
         if f is None:
             return None
         return py_field_get_str(f, self._record)
 
+    def value(self, name):
+        """
+        Return the value of field @name directly: a string for string
+        fields, a buffer for other arrays and a number otherwise, or
+        None if the event has no such field. Unlike event[name] no
+        Field object is created, so prefer this when only the value
+        is needed.
+        """
+        f = self._any_field(name)
+        if f is None:
+            return None
+        return py_field_value(f, self._record)
+
+    def read_str_field(self, name, buf):
+        """
+        Copy the string field @name into the bytearray @buf, growing
+        it if needed, and return the string's length, or None if the
+        event has no such field. Reusing @buf across events avoids
+        creating a string object per read.
+        """
+        f = self._any_field(name)
+        if f is None:
+            return None
+        return py_field_read_str_into(f, self._record, buf)
+
 class TraceSeq(object):
     def __init__(self, trace_seq):
         self._trace_seq = trace_seq
@@ -128,18 +181,24 @@ class FieldError(Exception):
     pass
 
 class Field(object):
+    __slots__ = ('_record', '_field', '_data_cache')
+
     def __init__(self, record, field):
         self._record = record
         self._field = field
+        self._data_cache = _MISSING
 
-    @cached_property
+    @property
     def data(self):
-        return py_field_get_data(self._field, self._record)
+        data = self._data_cache
+        if data is _MISSING:
+            data = py_field_get_data(self._field, self._record)
+            self._data_cache = data
+        return data
 
     def __long__(self):
-        ret, val =  pevent_read_number_field(self._field,
-                                             pevent_record_data_get(self._record))
-        if ret:
+        val = py_field_read_number(self._field, self._record)
+        if val is None:
             raise FieldError("Not a number field")
         return val
     __int__ = __long__
@@ -148,11 +207,20 @@ class Field(object):
         return py_field_get_str(self._field, self._record)
 
 class PEvent(object):
+    __slots__ = ('_pevent', '_fields', '_own_fields', '_comms',
+                 '_file_endian')
+
     def __init__(self, pevent):
         self._pevent = pevent
+        self._fields = {}
+        self._own_fields = {}
+        self._comms = {}
+        self._file_endian = _MISSING
 
     def _handler(self, cb, s, record, event_fmt):
-        return cb(TraceSeq(s), Event(self._pevent, record, event_fmt))
+        return cb(TraceSeq(s), Event(self._pevent, record, event_fmt,
+                                     self._fields, self._own_fields,
+                                     self._comms))
 
     def register_event_handler(self, subsys, event_name, callback):
         l = lambda s, r, e: self._handler(callback, s, r, e)
@@ -160,11 +228,16 @@ class PEvent(object):
         py_pevent_register_event_handler(
                   self._pevent, -1, subsys, event_name, l)
 
-    @cached_property
+    @property
     def file_endian(self):
-        if pevent_is_file_bigendian(self._pevent):
-            return '>'
-        return '<'
+        endian = self._file_endian
+        if endian is _MISSING:
+            if pevent_is_file_bigendian(self._pevent):
+                endian = '>'
+            else:
+                endian = '<'
+            self._file_endian = endian
+        return endian
 
 
 class FileFormatError(Exception):
@@ -187,39 +260,245 @@ class Trace(object):
             raise FileFormatError("Failed to init data")
 
         self._pevent = tracecmd_get_pevent(self._handle)
+        self.cpus = tracecmd_cpus(self._handle)
+        self._formats = {}
+        self._fields = {}
+        self._own_fields = {}
+        self._comms = {}
+        self._start_time = None
+        self._end_time = None
+
+    def _read_time_range(self):
+        # one pass over the CPUs fills in both ends
+        ranges = py_tracecmd_cpu_time_range(self._handle)
+        self._start_time = [first for first, last in ranges]
+        self._end_time = [last for first, last in ranges]
+        # the whole-trace values, reduced once here instead of per call
+        self._first_ts = min([v for v in self._start_time if v > 0] or [0])
+        self._last_ts = max(self._end_time or [0])
+
+    def start_time(self, cpu=-1):
+        """
+        Return the timestamp of the first event on @cpu, or of the
+        first event in the trace if @cpu is -1. CPUs without data
+        report 0.
+        """
+        if cpu != -1 and not 0 <= cpu < self.cpus:
+            raise ValueError("invalid cpu")
+        if self._start_time is None:
+            self._read_time_range()
+        if cpu != -1:
+            return self._start_time[cpu]
+        return self._first_ts
+
+    def end_time(self, cpu=-1):
+        """
+        Return the timestamp of the last event on @cpu, or of the
+        last event in the trace if @cpu is -1.
+        """
+        if cpu != -1 and not 0 <= cpu < self.cpus:
+            raise ValueError("invalid cpu")
+        if self._end_time is None:
+            self._read_time_range()
+        if cpu != -1:
+            return self._end_time[cpu]
+        return self._last_ts
+
+    def _unread(self, recs):
+        # put each CPU back on the first of the (record, type) pairs in
+        # @recs it owns, so records a batch read ahead can be read again
+        seen = set()
+        for rec, type in recs:
+            cpu = pevent_record_cpu_get(rec)
+            if cpu not in seen:
+                seen.add(cpu)
+                tracecmd_set_cursor(self._handle, cpu,
+                                    pevent_record_offset_get(rec))
+
+    def _event_type(self, type):
+        # resolved once per event type, there are few of them
+        try:
+            return self._formats[type]
+        except KeyError:
+            format = pevent_data_event_from_type(self._pevent, type)
+            entry = self._formats[type] = (format, _format_name(format))
+            return entry
 
-    @cached_property
-    def cpus(self):
-        return tracecmd_cpus(self._handle)
+    def _create_event(self, rec):
+        format, name = self._event_type(pevent_data_type(self._pevent, rec))
+        return Event(self._pevent, rec, format, self._fields,
+                     self._own_fields, self._comms, name)
 
     def read_event(self, cpu):
         rec = tracecmd_read_data(self._handle, cpu)
         if rec:
-            type = pevent_data_type(self._pevent, rec)
-            format = pevent_data_event_from_type(self._pevent, type)
-            # rec ownership goes over to Event instance
-            return Event(self._pevent, rec, format)
+            return self._create_event(rec)
         return None
 
+    def events(self, cpu=-1, batch=4096, autoclose=False):
+        """
+        Iterate over the events of @cpu, or over the events of each
+        CPU in turn if @cpu is -1. Records are pulled from the C
+        library @batch at a time.
+
+        With @autoclose set, each event is closed as soon as the next
+        one is requested, or when the iteration is closed. Callers
+        must then copy out anything they want to keep before moving
+        on.
+        """
+        if cpu == -1:
+            cpus = range(0, self.cpus)
+        else:
+            cpus = [cpu]
+
+        return self._read_events(cpus, batch, autoclose)
+
+    def read_next_event(self):
+        """
+        Read the next event in time order across all CPUs, or return
+        None at the end of the trace.
+        """
+        res = tracecmd_read_next_data(self._handle)
+        # SWIG only returns the CPU if the record is None
+        if isinstance(res, int):
+            return None
+        rec, cpu = res
+        return self._create_event(rec)
+
+    def events_merged(self, start_time=0, end_time=0, batch=4096,
+                      autoclose=False):
+        """
+        Iterate over the events of all CPUs in timestamp order, as
+        opposed to events(), which walks one CPU after the other.
+        A non-zero @start_time first moves every CPU to that time,
+        and iteration stops after @end_time if it is non-zero.
+        @batch and @autoclose behave as for events().
+        """
+        return self._read_events([-1], batch, autoclose, start_time,
+                                 end_time)
+
+    def _read_events(self, cpus, batch, autoclose, start_time=0,
+                     end_time=0):
+        # the batch -> Event pump behind events() and events_merged(),
+        # a cpu of -1 in @cpus reads all CPUs in time order
+
+        # bind everything the loop touches to locals (LOAD_FAST)
+        read_batch = py_read_data_batch
+        event = Event
+        handle = self._handle
+        pevent = self._pevent
+        fields = self._fields
+        own_fields = self._own_fields
+        comms = self._comms
+        formats = self._formats
+        event_type = self._event_type
+
+        if start_time:
+            tracecmd_set_all_cpus_to_timestamp(handle, start_time)
+
+        for cpu in cpus:
+            while True:
+                recs = read_batch(handle, cpu, batch)
+                if not recs:
+                    break
+                # recs[done:] were read ahead but not handed out yet
+                done = 0
+                try:
+                    for i in xrange(len(recs)):
+                        rec, type = recs[i]
+                        try:
+                            format, name = formats[type]
+                        except KeyError:
+                            format, name = event_type(type)
+                        ev = event(pevent, rec, format, fields, own_fields,
+                                   comms, name)
+                        rec = None
+                        if end_time and ev.ts > end_time:
+                            return
+                        # leave the event as the only owner of its record
+                        recs[i] = None
+                        done = i + 1
+                        # the CPUs were set to a page before start_time
+                        if ev.ts < start_time:
+                            continue
+                        try:
+                            yield ev
+                        finally:
+                            # also when the generator is closed or dropped
+                            if autoclose:
+                                ev.close()
+                finally:
+                    if done < len(recs):
+                        self._unread(recs[done:])
+
+    def raw_events(self, cpu=-1, fields=_RAW_FIELDS, batch=65536,
+                   merged=False):
+        """
+        Iterate over the records of @cpu (or of each CPU in turn if
+        @cpu is -1) like events() does, but without creating Event
+        objects. With @merged set, the records of all CPUs are read
+        in time order instead. Each step yields a dict mapping every
+        name in @fields to a list of values, one per record, for up
+        to @batch records. This is the fast path for statistics over
+        a trace.
+        """
+        for name in fields:
+            if name not in _RAW_FIELDS:
+                raise ValueError("unknown raw field '%s'" % name)
+        want_pid = 'pid' in fields
+
+        if merged:
+            cpus = [-1]
+        elif cpu == -1:
+            cpus = range(0, self.cpus)
+        else:
+            cpus = [cpu]
+
+        read_batch = py_read_raw_batch
+        handle = self._handle
+
+        for cpu in cpus:
+            while True:
+                cols = read_batch(handle, cpu, batch, want_pid)
+                if not cols[0]:
+                    break
+                cols = dict(zip(_RAW_FIELDS, cols))
+                yield dict((name, cols[name]) for name in fields)
+
+    def num_field_vector(self, event_name, field_name, cpu=-1,
+                         start_ts=0, end_ts=0):
+        """
+        Return a list with the number field @field_name of every
+        @event_name event on @cpu (or on each CPU in turn if @cpu is
+        -1) between @start_ts and @end_ts, where an @end_ts of 0
+        means the end of the trace. @event_name may be given as
+        "system:name". The whole walk is done in C, and the CPU
+        iterators used by read_event() and events() are not moved.
+        """
+        system, _, name = event_name.rpartition(':')
+        format = pevent_find_event_by_name(self._pevent, system or None, name)
+        if format is None:
+            raise ValueError("unknown event '%s'" % event_name)
+        f = pevent_find_any_field(format, field_name)
+        if f is None:
+            raise ValueError("event '%s' has no field '%s'" %
+                             (event_name, field_name))
+        return py_read_field_vector(self._handle, cpu, format, f,
+                                    start_ts, end_ts)
+
     def read_event_at(self, offset):
         res = tracecmd_read_at(self._handle, offset)
         # SWIG only returns the CPU if the record is None for some reason
         if isinstance(res, int):
             return None
         rec, cpu = res
-        type = pevent_data_type(self._pevent, rec)
-        format = pevent_data_event_from_type(self._pevent, type)
-        # rec ownership goes over to Event instance
-        return Event(self._pevent, rec, format)
+        return self._create_event(rec)
 
     def peek_event(self, cpu):
         rec = tracecmd_peek_data_ref(self._handle, cpu)
         if rec is None:
             return None
-        type = pevent_data_type(self._pevent, rec)
-        format = pevent_data_event_from_type(self._pevent, type)
-        # rec ownership goes over to Event instance
-        return Event(self._pevent, rec, format)
+        return self._create_event(rec)
 
 
 # Basic builtin test, execute module directly